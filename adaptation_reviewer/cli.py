@@ -1,19 +1,29 @@
 import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Tuple
+from typing import List, Tuple
 
 import typer
 import pandas as pd
 from typing_extensions import Annotated
 
-from adaptation_reviewer.download import download_paper
+from adaptation_reviewer.download import (
+    assign_socks_port,
+    download_paper_worker,
+)
 from adaptation_reviewer.pbar import progress_bar
 from adaptation_reviewer.process import (
+    build_faiss_index,
     create_connection,
     create_embeddings_abstracts,
     create_table,
+    load_embeddings,
+)
+from adaptation_reviewer.transform import (
+    generate_parquet_from_list,
+    json_to_parquet_duckdb,
 )
-from adaptation_reviewer.transform import generate_parquet_from_list
 
 logging.basicConfig(
     level=logging.INFO,
@@ -34,7 +44,9 @@ def transform_crossref(
         ..., help="Path to saved parquet files"
     ),
     row_group_size: int = typer.Option(
-        100_000, help="Row group size for parquet files"
+        1_000_000,
+        help="Row group size for parquet files. Each writer buffers one row "
+        "group in memory, so lower it to reduce memory use",
     ),
     rows_per_file: int = typer.Option(
         1_000_000, help="Number of rows per parquet file"
@@ -42,6 +54,9 @@ def transform_crossref(
     verbose: bool = typer.Option(False, help=VERBOSE_HELP),
     flatten_authors: bool = typer.Option(False, help="Flatten the author data"),
     n_jobs: int = typer.Option(5, help="Number of jobs to use. Use -1 for all"),
+    n_writers: int = typer.Option(
+        2, help="Number of parquet files written at the same time"
+    ),
 ) -> None:
     """
     Transform a list of DOIs records from JSON into a parquet files
@@ -60,6 +75,36 @@ def transform_crossref(
         rows_per_file,
         n_jobs,
         flatten_authors,
+        n_writers=n_writers,
+    )
+
+    return None
+
+
+@app.command()
+def transform_duckdb(
+    path_to_cf: str = typer.Argument(..., help="Path to raw crossref data"),
+    path_to_parquet: str = typer.Argument(
+        ..., help="Path to saved parquet files"
+    ),
+    row_group_size: int = typer.Option(
+        1_000_000, help="Row group size for parquet files"
+    ),
+    rows_per_file: int = typer.Option(
+        1_000_000, help="Number of rows per parquet file"
+    ),
+    flatten_authors: bool = typer.Option(False, help="Flatten the author data"),
+) -> None:
+    """
+    Transform DOIs records from JSON into parquet files using DuckDB
+    """
+
+    json_to_parquet_duckdb(
+        path_to_cf,
+        path_to_parquet,
+        row_group_size,
+        rows_per_file,
+        flatten_authors,
     )
 
     return None
@@ -74,6 +119,9 @@ def create_db(
         typer.Option(help="Keywords to filter the abstracts"),
     ] = ("adaptation", "mortality", "temperature"),
     table_name: str = typer.Option("papers", help="Name of the table"),
+    matcher: str = typer.Option(
+        "regex", help="Keyword matcher: regex or aho-corasick (plain keywords)"
+    ),
 ) -> None:
     """
     Create a DuckDB database with DOI records from Parquet files
@@ -85,6 +133,7 @@ def create_db(
         keyords=list(keywords),
         table_name=table_name,
         con=con,
+        matcher=matcher,
     )
 
     return None
@@ -104,6 +153,34 @@ def embed_abstracts(
     csv_file: str = typer.Option(
         None, help="CSV file to embed. Optional if data not in DB"
     ),
+    batch_size: int = typer.Option(64, help="Batch size for the encoder"),
+    device: str = typer.Option(
+        None, help="Device to run the model (cuda, cpu). Default: auto"
+    ),
+    precision: str = typer.Option(
+        "fp32", help="Encoder precision: fp32, fp16 (CUDA only) or int8 (ONNX)"
+    ),
+    quantization_config: str = typer.Option(
+        None,
+        help="int8 quantization: arm64, avx2, avx512, avx512_vnni. Default: auto",
+    ),
+    multi_gpu: bool = typer.Option(
+        False, help="Shard the encoding across all available GPUs"
+    ),
+    chunk_size: int = typer.Option(
+        10_000, help="Number of abstracts read from the DB at a time"
+    ),
+    hnsw_index: bool = typer.Option(
+        False,
+        help="Build a DuckDB HNSW index on the embeddings. Experimental: uses "
+        "the vss extension's experimental persistence",
+    ),
+    faiss_index: str = typer.Option(
+        None, help="Path to save a FAISS index of the embeddings. Optional"
+    ),
+    faiss_type: str = typer.Option(
+        "hnsw", help="FAISS index type: hnsw or hnsw_sq8 (int8)"
+    ),
 ) -> None:
     """
     Use a LLM to embed the abstracts of DOI records the database
@@ -130,8 +207,19 @@ def embed_abstracts(
         key="uuid",
         abstract_key="abstract",
         con=con,
+        batch_size=batch_size,
+        device=device,
+        precision=precision,
+        quantization_config=quantization_config,
+        multi_gpu=multi_gpu,
+        chunk_size=chunk_size,
+        hnsw_index=hnsw_index,
     )
 
+    if faiss_index is not None:
+        _, embeddings = load_embeddings(table_name=table_name, con=con)
+        build_faiss_index(embeddings, path=faiss_index, index_type=faiss_type)
+
     return None
 
 
@@ -144,22 +232,56 @@ def download(
     path_pdfs: str = typer.Option(
         "papers", help="Path to save the downloaded papers"
     ),
+    n_workers: int = typer.Option(8, help="Number of parallel downloads"),
+    socks_ports: List[int] = typer.Option(
+        [9050], help="Tor SOCKS ports. Each worker uses its own port"
+    ),
 ) -> None:
     """
     Download papers from the DOIs in the database
     """
     con = create_connection(db_name=db_name)
 
-    papers = con.execute(f"SELECT * FROM {table_name}").df()
+    papers = con.execute(f"SELECT doi, uuid FROM {table_name}").df()
 
-    with progress_bar as p:
-        for i in p.track(range(len(papers) - 1)):
-            doi_url = papers.loc[i, "doi"]
-            uuid = papers.loc[i, "uuid"]
-
-            download_paper(
-                doi_url, uuid, path_pdfs, password="torpasslitreview"
+    # Each worker takes one port, so we cannot have more workers than ports
+    if n_workers > len(socks_ports):
+        logger.warning(
+            f"Only {len(socks_ports)} SOCKS ports for {n_workers} workers. "
+            f"Using {len(socks_ports)} workers"
+        )
+        n_workers = len(socks_ports)
+
+    ports = queue.SimpleQueue()
+    for port in socks_ports[:n_workers]:
+        ports.put(port)
+
+    with (
+        progress_bar as p,
+        ThreadPoolExecutor(
+            max_workers=n_workers,
+            initializer=assign_socks_port,
+            initargs=(ports,),
+        ) as pool,
+    ):
+        task = p.add_task(table_name, total=len(papers))
+        futures = [
+            pool.submit(
+                download_paper_worker,
+                doi_url,
+                uuid,
+                path_pdfs,
+                password="torpasslitreview",
             )
+            for doi_url, uuid in papers.itertuples(index=False, name=None)
+        ]
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Download failed: {e}")
+            p.advance(task)
 
     return None
 
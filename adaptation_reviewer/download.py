@@ -1,10 +1,29 @@
+import logging
 import os
+import queue
+import threading
 from pathlib import Path
+from time import monotonic
 import requests
 from scidownl import scihub_download
 from stem import Signal
 from stem.control import Controller
 
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Tor ignores NEWNYM signals sent less than 10 seconds apart. Keep track of the
+# last renewal so concurrent downloads do not flood the controller
+NEWNYM_INTERVAL = 10
+_newnym_lock = threading.Lock()
+_last_newnym = float("-inf")
+
+# SOCKS port of each download worker thread, see `assign_socks_port`
+_worker = threading.local()
+
 
 def get_current_ip():
     """Helper function to get the current IP address and test if Tor socket
@@ -26,7 +45,7 @@ def get_current_ip():
         return r.text
 
 
-def renew_tor_ip(password, port=9051) -> None:
+def renew_tor_ip(password, port=9051, min_interval=NEWNYM_INTERVAL) -> bool:
     """Renew end node from Tor connection
 
     We want to renew the end node to avoid being blocked by Sci-Hub or any other
@@ -42,6 +61,12 @@ def renew_tor_ip(password, port=9051) -> None:
     CookieAuthentication 1
     ```
 
+    To download in parallel, add one `SocksPort` line per worker (i.e.
+    `SocksPort 9050`, `SocksPort 9052`, `SocksPort 9054`). Tor never shares
+    circuits between different `SocksPort`, so each worker gets its own
+    circuit. Since NEWNYM applies to all circuits, renewals sent less than
+    `min_interval` seconds apart are skipped.
+
     The password for the controller can be found in the `hash` file in the Tor
     data directory. The default location for the data directory is:
 
@@ -57,20 +82,72 @@ def renew_tor_ip(password, port=9051) -> None:
     port : int
         Port to connect to the Tor controller. Default is 9051.
 
+    min_interval : float
+        Minimum number of seconds between renewals. Default is 10.
+
     Returns
     -------
-    None
+    bool
+        True if a NEWNYM signal was sent, False if it was skipped because the
+        last renewal was less than `min_interval` seconds ago
     """
+    global _last_newnym
+
+    # Only reserve the renewal under the lock, so other workers do not wait
+    # while we talk to the controller
+    with _newnym_lock:
+        now = monotonic()
+        if now - _last_newnym < min_interval:
+            logger.debug("Skipping NEWNYM, last renewal was too recent")
+            return False
+        _last_newnym = now
 
     with Controller.from_port(port=port) as controller:
         controller.authenticate(password=password)
         controller.signal(Signal.NEWNYM)
 
+    return True
+
+
+def assign_socks_port(ports: queue.SimpleQueue) -> None:
+    """Take a SOCKS port for the current worker thread
+
+    This function is meant to be used as the `initializer` of a
+    `ThreadPoolExecutor`, with one port in `ports` per worker, so each worker
+    keeps its own Tor port (and circuit) for all its downloads. See
+    `download_paper_worker`.
+
+    Parameters
+    ----------
+    ports : queue.SimpleQueue
+        Queue with the available Tor SOCKS ports
+
+    Returns
+    -------
+    None
+    """
+
+    _worker.socks_port = ports.get_nowait()
+
     return None
 
 
-def download_paper(
+def download_paper_worker(
     doi_url: str, uuid: str, path_pdfs: str | Path, **kwargs
+) -> None:
+    """Run `download_paper` with the SOCKS port of the current worker thread"""
+
+    return download_paper(
+        doi_url, uuid, path_pdfs, socks_port=_worker.socks_port, **kwargs
+    )
+
+
+def download_paper(
+    doi_url: str,
+    uuid: str,
+    path_pdfs: str | Path,
+    socks_port: int = 9050,
+    **kwargs,
 ) -> None:
     """Donwnload a paper from Sci-Hub using the DOI URL
 
@@ -88,6 +165,8 @@ def download_paper(
         Last name of the first author of the paper
     path_pdfs : str
         Path to save the downloaded PDF file
+    socks_port : int
+        Tor SOCKS port to use as proxy. Default is 9050.
     **kwargs : dict
         Additional keyword arguments to pass to the `renew_tor_ip` function
 
@@ -105,10 +184,11 @@ def download_paper(
 
     if not os.path.exists(out):
         proxy = {
-            "http": "socks5://localhost:9050",
-            "https": "socks5://localhost:9050",
+            "http": f"socks5://localhost:{socks_port}",
+            "https": f"socks5://localhost:{socks_port}",
         }
-        # Renew the Tor IP address at each request! Proxy stays the same
+        # Renew the Tor IP address before the request, unless it was renewed
+        # less than NEWNYM_INTERVAL seconds ago. Proxy stays the same
         renew_tor_ip(**kwargs)
         scihub_download(doi_url, paper_type="doi", out=out, proxies=proxy)
     else:
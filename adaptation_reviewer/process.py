@@ -1,8 +1,13 @@
 import logging
-from typing import List
+import os
+import platform
+from pathlib import Path
+from typing import List, Tuple
 import numpy as np
 import pandas as pd
 import duckdb
+import pyarrow as pa
+import torch
 from sentence_transformers import SentenceTransformer
 
 from adaptation_reviewer.pbar import progress_bar
@@ -14,27 +19,140 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def create_connection(db_name: str = None) -> duckdb.duckdb.DuckDBPyConnection:
+def load_vss(
+    con: duckdb.duckdb.DuckDBPyConnection, hnsw_persistence: bool = False
+) -> None:
+    """Install and load the vector similarity extension if needed
+
+    Parameters
+    ----------
+    con : duckdb.duckdb.DuckDBPyConnection
+        Connection to the database
+    hnsw_persistence : bool, optional
+        Allow HNSW indexes in on-disk databases. This is an experimental vss
+        feature with WAL recovery caveats, so only enable it on connections
+        that build an index. The default is False.
+    """
+
+    installed, loaded = con.execute(
+        """
+        SELECT installed, loaded FROM duckdb_extensions()
+        WHERE extension_name = 'vss'
+        """
+    ).fetchone() or (False, False)
+    if not installed:
+        con.execute("INSTALL vss;")
+    if not loaded:
+        con.execute("LOAD vss;")
+
+    if hnsw_persistence:
+        con.execute("SET hnsw_enable_experimental_persistence=true;")
+
+    return None
+
+
+def create_connection(
+    db_name: str = None,
+    threads: None | int = None,
+    memory_limit: None | str = None,
+) -> duckdb.duckdb.DuckDBPyConnection:
     if not db_name:
         db_name = ":memory:"
 
+    if threads is None:
+        threads = os.cpu_count()
+
     con = duckdb.connect(database=db_name, read_only=False)
 
     # Use vector similarity extension
-    con.execute("INSTALL vss;")
-    con.execute("LOAD vss;")
+    load_vss(con)
+
+    # Use all cores
+    con.execute(f"PRAGMA threads={threads};")
+    if memory_limit is not None:
+        con.execute(f"PRAGMA memory_limit='{memory_limit}';")
 
-    logger.debug("Connection to DuckDB created in {db_name}")
+    logger.debug(f"Connection to DuckDB created in {db_name}")
 
     return con
 
 
+def register_keyword_matcher(
+    keywords: List[str],
+    con: duckdb.duckdb.DuckDBPyConnection,
+    name: str = "kw_match",
+) -> None:
+    """Register a DuckDB function that checks all keywords in one pass
+
+    The function builds an Aho-Corasick automaton with the lowercased keywords
+    and registers a vectorized (Arrow) UDF called `name`, that returns True if
+    the text contains all the keywords. Each text is scanned once for all the
+    keywords, instead of once per keyword. Keywords are matched as plain
+    strings, not as regular expressions.
+
+    This function requires `pyahocorasick` (`pip install pyahocorasick`).
+
+    Parameters
+    ----------
+    keywords : list
+        Keywords that should all be in the text
+    con : duckdb.duckdb.DuckDBPyConnection
+        Connection to register the function in
+    name : str, optional
+        Name of the SQL function. The default is "kw_match".
+    """
+    try:
+        import ahocorasick
+    except ImportError as e:
+        raise ImportError(
+            "pyahocorasick is required for this matcher: pip install pyahocorasick"
+        ) from e
+
+    automaton = ahocorasick.Automaton()
+    for idx, key in enumerate(keywords):
+        automaton.add_word(key.lower(), idx)
+    automaton.make_automaton()
+
+    n_keywords = len(set(key.lower() for key in keywords))
+
+    def match(text: None | str) -> bool:
+        if text is None:
+            return False
+
+        found = set()
+        for _, idx in automaton.iter(text.lower()):
+            found.add(idx)
+            if len(found) == n_keywords:
+                return True
+        return False
+
+    def kw_match(texts: pa.Array) -> pa.Array:
+        return pa.array([match(text) for text in texts.to_pylist()], pa.bool_())
+
+    # Replace the function if it was registered with other keywords
+    try:
+        con.remove_function(name)
+    except duckdb.Error:
+        pass
+
+    con.create_function(
+        name,
+        kw_match,
+        [duckdb.type("VARCHAR")],
+        duckdb.type("BOOLEAN"),
+        type="arrow",
+    )
+
+    return None
+
+
 def create_table(
     path_parquet: str,
     keyords: str | List,
     table_name: str,
     con=None,
     create_table: bool = True,
+    matcher: str = "regex",
     **kwargs,
 ) -> None | pd.DataFrame:
     """Create a SQL filtered table by keywords in the abstract
@@ -52,6 +170,11 @@ def create_table(
         Name of the table to create
     con : duckdb.duckdb.DuckDBPyConnection, optional
         Connection to the database. The default is None.
+    matcher : str, optional
+        How to match the keywords. "regex" uses one DuckDB regular expression
+        per keyword. "aho-corasick" scans each abstract once for all keywords
+        with `register_keyword_matcher`, but only supports plain keywords. The
+        default is "regex".
     kwargs : dict
         Keyword arguments to pass to the `create_connection` function
     """
@@ -59,12 +182,22 @@ def create_table(
     if not con:
         con = create_connection(**kwargs)
 
-    if isinstance(keyords, list):
+    if isinstance(keyords, str):
+        keyords = [keyords]
+
+    # Pass keywords as parameters so DuckDB compiles each pattern once for the
+    # whole scan. Keywords are regexes, so pass them unchanged
+    if matcher == "regex":
+        params = list(keyords)
         keyords = " AND ".join(
-            [f"regexp_matches(abstract, '{key}', 'i')" for key in keyords]
+            ["regexp_matches(abstract, ?, 'i')" for _ in keyords]
         )
+    elif matcher == "aho-corasick":
+        register_keyword_matcher(keyords, con=con)
+        params = []
+        keyords = "kw_match(abstract)"
     else:
-        keyords = f"regexp_matches(abstract, '{keyords}', 'i')"
+        raise ValueError(f"Invalid matcher: {matcher}")
 
     query = f"""
         SELECT 
@@ -74,15 +207,16 @@ def create_table(
         family_1 || ', ' || given_1 AS first_author, 
         year::INT AS year,
         TRIM(
-            regexp_replace(
-                regexp_replace(
-                    regexp_replace(abstract, 'Abstract', '', 'g'),
-                    '<[^>]+>', '', 'g'
-                ),
-                '\n', ' ', 'g'
+            replace(
+                regexp_replace(abstract, 'Abstract|<[^>]+>', '', 'g'),
+                '\n', ' '
             )
             ) AS abstract,
-        FROM read_parquet('{path_parquet}/*.parquet', union_by_name=True)
+        FROM read_parquet(
+            '{path_parquet}/*.parquet',
+            union_by_name=True,
+            hive_partitioning=False
+        )
         WHERE {keyords}
         AND type = 'journal-article'
         AND abstract IS NOT NULL
@@ -99,21 +233,161 @@ def create_table(
 
         query = f"CREATE TABLE {table_name} AS ({query});"
 
-        con.execute(query)
+        con.execute(query, params)
         logger.debug(f"SQL Table created: {table_name}")
     else:
-        query = con.sql(query)
-        return query.to_df()
+        return con.execute(query, params).df()
 
     return None
 
 
+QUANTIZATION_CONFIGS = ("arm64", "avx2", "avx512", "avx512_vnni")
+
+
+def default_quantization_config() -> str:
+    """Pick the ONNX int8 quantization config that matches this CPU
+
+    ARM machines use `arm64`. On x86, the CPU flags in `/proc/cpuinfo` are
+    used to pick `avx512_vnni`, `avx512` or `avx2`. If the flags cannot be
+    read (i.e. macOS), `avx2` is used as the most portable x86 option.
+    """
+
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(
+                next(
+                    (line for line in f if line.startswith("flags")), ""
+                ).split()
+            )
+    except OSError:
+        return "avx2"
+
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    elif "avx512f" in flags:
+        return "avx512"
+
+    return "avx2"
+
+
+def load_embedding_model(
+    model: str,
+    device: str = "cpu",
+    precision: str = "fp32",
+    onnx_dir: None | str | Path = None,
+    quantization_config: None | str = None,
+) -> SentenceTransformer:
+    """Load a SentenceTransformer model with the requested precision
+
+    `fp32` loads the model as is. `fp16` casts the model weights to half
+    precision, which is only done when running on CUDA. `int8` exports the
+    model to ONNX and applies dynamic int8 quantization; the quantized model is
+    cached in `onnx_dir` and always runs on CPU through `onnxruntime`.
+
+    Parameters
+    ----------
+    model : str
+        SentenceTransformer model to use
+    device : str, optional
+        Torch device to run the model on. The default is "cpu".
+    precision : str, optional
+        One of "fp32", "fp16" or "int8". The default is "fp32".
+    onnx_dir : str or Path, optional
+        Directory to save the quantized ONNX model. The default is
+        `~/.cache/adaptation_reviewer/<model>`.
+    quantization_config : str, optional
+        One of "arm64", "avx2", "avx512" or "avx512_vnni". If None, use
+        `default_quantization_config`. The default is None.
+
+    Returns
+    -------
+    SentenceTransformer
+    """
+
+    if precision not in ("fp32", "fp16", "int8"):
+        raise ValueError(f"Invalid precision: {precision}")
+
+    if precision == "int8":
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        if onnx_dir is None:
+            onnx_dir = (
+                Path.home()
+                / ".cache"
+                / "adaptation_reviewer"
+                / model.replace("/", "_")
+            )
+        onnx_dir = Path(onnx_dir)
+
+        if quantization_config is None:
+            quantization_config = default_quantization_config()
+        if quantization_config not in QUANTIZATION_CONFIGS:
+            raise ValueError(
+                f"Invalid quantization config: {quantization_config}"
+            )
+
+        # One file per config, so a cached model is never used on a CPU it
+        # was not quantized for
+        file_suffix = f"qint8_{quantization_config}"
+        file_name = f"onnx/model_{file_suffix}.onnx"
+
+        if not (onnx_dir / file_name).exists():
+            logger.info(
+                f"Exporting {model} to int8 ONNX ({quantization_config}) in "
+                f"{onnx_dir}"
+            )
+            onnx_model = SentenceTransformer(model, device="cpu", backend="onnx")
+            onnx_model.save(str(onnx_dir))
+
+            config = quantization_config
+            if config == "avx2":
+                from optimum.onnxruntime.configuration import (
+                    AutoQuantizationConfig,
+                )
+
+                # Without VNNI, int8 products can saturate. Use 7-bit weights
+                config = AutoQuantizationConfig.avx2(
+                    is_static=False, reduce_range=True
+                )
+
+            export_dynamic_quantized_onnx_model(
+                onnx_model,
+                quantization_config=config,
+                model_name_or_path=str(onnx_dir),
+                file_suffix=file_suffix,
+            )
+
+        return SentenceTransformer(
+            str(onnx_dir),
+            device="cpu",
+            backend="onnx",
+            model_kwargs={"file_name": file_name},
+        )
+
+    embedding_model = SentenceTransformer(model, device=device)
+
+    if precision == "fp16" and device.startswith("cuda"):
+        embedding_model.half()
+
+    return embedding_model
+
+
 def create_embeddings_abstracts(
     model: str,
     table_name: str,
     con: None | duckdb.duckdb.DuckDBPyConnection = None,
     key: str = "uuid",
     abstract_key: str = "abstract",
+    batch_size: int = 64,
+    device: None | str = None,
+    precision: str = "fp32",
+    quantization_config: None | str = None,
+    multi_gpu: bool = False,
+    chunk_size: int = 10_000,
+    hnsw_index: bool = False,
     **kwargs,
 ) -> None:
     """Create embedding table in DuckDB dataset
@@ -130,39 +404,296 @@ def create_embeddings_abstracts(
         Name of the table to create
     con : duckdb.duckdb.DuckDBPyConnection, optional
         Connection to the database. The default is None.
+    batch_size : int, optional
+        Number of abstracts to encode per batch. The default is 64.
+    device : str, optional
+        Torch device to run the model on (i.e. "cuda", "cpu"). If None, use
+        CUDA when available. The default is None.
+    precision : str, optional
+        Precision of the encoder: "fp32", "fp16" or "int8". Embeddings are
+        always stored as FLOAT4. The default is "fp32".
+    quantization_config : str, optional
+        ONNX quantization config for the "int8" precision. If None, pick it
+        from the CPU. The default is None.
+    multi_gpu : bool, optional
+        If True and more than one GPU is available, shard the abstracts across
+        all GPUs using a multi-process pool. The default is False.
+    chunk_size : int, optional
+        Number of abstracts fetched from DuckDB and encoded at a time. Only one
+        chunk is kept in memory. The default is 10_000.
+    hnsw_index : bool, optional
+        Build a cosine HNSW index on the embeddings table. Experimental: it
+        needs the vss extension and its experimental persistence, which can
+        corrupt the database file on a crash. The default is False.
     kwargs : dict
         Keyword arguments to pass to the `create_connection` function
     """
 
-    embedding_model = SentenceTransformer(model)
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # Use all cores when encoding on CPU
+    if device == "cpu" or precision == "int8":
+        torch.set_num_threads(os.cpu_count())
+
+    embedding_model = load_embedding_model(
+        model,
+        device=device,
+        precision=precision,
+        quantization_config=quantization_config,
+    )
     embed_size = embedding_model.get_sentence_embedding_dimension()
 
-    abstracts = con.sql(
+    if not con:
+        con = create_connection(**kwargs)
+
+    # Set up vss before encoding, so a missing extension fails early and not
+    # after all the abstracts are encoded
+    if hnsw_index:
+        load_vss(con, hnsw_persistence=True)
+
+    con.execute(
         f"""
-        SELECT {key}, {abstract_key} FROM {table_name}
-        where {abstract_key} IS NOT NULL
+        CREATE OR REPLACE TABLE {table_name}_embed_abstracts
+        (id STRING, embeddings FLOAT4[{embed_size}]);
         """
-    ).to_df()
+    )
+
+    n_abstracts = con.sql(
+        f"SELECT count(*) FROM {table_name} WHERE {abstract_key} IS NOT NULL"
+    ).fetchone()[0]
 
-    embeddings = embedding_model.encode(
-        abstracts.abstract.tolist(), show_progress_bar=True
+    # Stream the abstracts in chunks from a separate cursor, so we can insert
+    # the embeddings of each chunk while the scan is still open
+    reader = (
+        con.cursor()
+        .execute(
+            f"""
+            SELECT {key}, {abstract_key} FROM {table_name}
+            where {abstract_key} IS NOT NULL
+            """
+        )
+        .fetch_record_batch(chunk_size)
     )
 
-    # Check that array is np.float32, otherwise transform it
-    if embeddings.dtype != np.float32:
-        embeddings = embeddings.astype("float32")
+    pool = None
+    if multi_gpu and torch.cuda.device_count() > 1 and precision != "int8":
+        logger.info(f"Encoding on {torch.cuda.device_count()} GPUs")
+        pool = embedding_model.start_multi_process_pool()
 
-    if not con:
-        con = create_connection(**kwargs)
+    try:
+        with progress_bar as p:
+            task = p.add_task(table_name, total=n_abstracts)
+            for batch in reader:
+                abstracts = batch.column(abstract_key).to_pylist()
 
-    con.execute(
-        f"CREATE OR REPLACE TABLE {table_name}_embed_abstracts (id STRING, embeddings FLOAT4[{embed_size}]);"
+                # SentenceTransformer sorts the abstracts by length before
+                # batching, so each batch is only padded to its longest
+                # abstract. With a pool, the batches are sharded across GPUs
+                embeddings = embedding_model.encode(
+                    abstracts,
+                    pool=pool,
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                )
+
+                # Check that array is np.float32, otherwise transform it
+                if embeddings.dtype != np.float32:
+                    embeddings = embeddings.astype("float32")
+
+                # Register embeddings as an Arrow table backed by one
+                # contiguous buffer and insert the chunk in one go
+                embed_tbl = pa.table(
+                    {
+                        "id": batch.column(key).cast(pa.string()),
+                        "embeddings": pa.FixedSizeListArray.from_arrays(
+                            pa.array(embeddings.reshape(-1)), embed_size
+                        ),
+                    }
+                )
+                con.register("embed_tmp", embed_tbl)
+                con.execute(
+                    f"""
+                    INSERT INTO {table_name}_embed_abstracts
+                    SELECT id, embeddings FROM embed_tmp
+                    """
+                )
+                con.unregister("embed_tmp")
+
+                p.advance(task, batch.num_rows)
+    finally:
+        if pool is not None:
+            embedding_model.stop_multi_process_pool(pool)
+
+    # HNSW index for cosine similarity queries
+    if hnsw_index:
+        con.execute(
+            f"""
+            CREATE INDEX {table_name}_embed_abstracts_idx
+            ON {table_name}_embed_abstracts
+            USING HNSW (embeddings)
+            WITH (metric = 'cosine')
+            """
+        )
+
+    logger.debug(
+        f"Inserted {n_abstracts:,} embeddings into {table_name}_embed_abstracts"
     )
 
-    # Create a new table with the embeddings
-    with progress_bar as p:
-        for i in p.track(range(abstracts.shape[0] - 1), description=table_name):
-            con.execute(
-                f"INSERT INTO {table_name}_embed_abstracts VALUES (?, ?)",
-                (abstracts.uuid.tolist()[i], embeddings[i, :]),
-            )
+    return None
+
+
+def load_embeddings(
+    table_name: str,
+    con: duckdb.duckdb.DuckDBPyConnection,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Load the embeddings created by `create_embeddings_abstracts`
+
+    The embeddings are fetched as an Arrow table and returned as a NumPy view
+    over the contiguous Arrow buffer, so no Python objects are created per
+    row.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the table with the abstracts (without `_embed_abstracts`)
+    con : duckdb.duckdb.DuckDBPyConnection
+        Connection to the database
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Array with the ids and a 2-D array of shape (n_abstracts, embed_size)
+    """
+
+    tbl = con.sql(
+        f"SELECT id, embeddings FROM {table_name}_embed_abstracts"
+    ).fetch_arrow_table()
+
+    # DuckDB returns FLOAT4[N] as a fixed size list: flatten to one buffer
+    embeddings = tbl.column("embeddings").combine_chunks()
+    embed_size = embeddings.type.list_size
+
+    ids = tbl.column("id").to_numpy()
+    embeddings = embeddings.flatten().to_numpy().reshape(-1, embed_size)
+
+    return ids, embeddings
+
+
+def similarity_search(
+    queries: np.ndarray,
+    embeddings: np.ndarray,
+    top_k: int = 10,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the most similar abstracts to a set of query embeddings
+
+    Similarity is the dot product of the queries and the embeddings, computed
+    with a single matrix product. Embeddings from `create_embeddings_abstracts`
+    are normalized, so this is the cosine similarity if the queries are
+    normalized too.
+
+    Parameters
+    ----------
+    queries : np.ndarray
+        Array of shape (n_queries, embed_size) or (embed_size,)
+    embeddings : np.ndarray
+        Array of shape (n_abstracts, embed_size)
+    top_k : int, optional
+        Number of results per query. The default is 10.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Indices of the `top_k` most similar abstracts and their similarity,
+        both with shape (n_queries, top_k) and sorted by similarity
+    """
+
+    queries = np.atleast_2d(queries).astype(embeddings.dtype, copy=False)
+    top_k = min(top_k, embeddings.shape[0])
+
+    # Nothing to rank
+    if top_k <= 0:
+        return (
+            np.empty((queries.shape[0], 0), dtype=np.int64),
+            np.empty((queries.shape[0], 0), dtype=embeddings.dtype),
+        )
+
+    scores = queries @ embeddings.T
+
+    # Partial sort to get the top k and then sort only those
+    idx = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    top_scores = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+
+    return (
+        np.take_along_axis(idx, order, axis=1),
+        np.take_along_axis(top_scores, order, axis=1),
+    )
+
+
+def build_faiss_index(
+    embeddings: np.ndarray,
+    path: None | str | Path = None,
+    index_type: str = "hnsw",
+    m: int = 32,
+    ef_construction: int = 200,
+):
+    """Build a FAISS HNSW index over the abstract embeddings
+
+    Embeddings from `create_embeddings_abstracts` are normalized, so the index
+    uses the inner product (cosine similarity). Positions in the index follow
+    the row order of `embeddings`, i.e. the ids returned by `load_embeddings`.
+    `hnsw` stores the vectors as float32, while `hnsw_sq8` stores them with
+    8-bit scalar quantization (4x smaller and faster int8 kernels).
+
+    This function requires `faiss` (`pip install faiss-cpu`).
+
+    Parameters
+    ----------
+    embeddings : np.ndarray
+        Array of shape (n_abstracts, embed_size)
+    path : str or Path, optional
+        Path to save the index. If None, the index is not saved.
+    index_type : str, optional
+        One of "hnsw" or "hnsw_sq8". The default is "hnsw".
+    m : int, optional
+        Number of neighbors per node in the HNSW graph. The default is 32.
+    ef_construction : int, optional
+        Search depth when building the HNSW graph. The default is 200.
+
+    Returns
+    -------
+    faiss.Index
+    """
+    try:
+        import faiss
+    except ImportError as e:
+        raise ImportError(
+            "faiss is required to build the index: pip install faiss-cpu"
+        ) from e
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    embed_size = embeddings.shape[1]
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(embed_size, m, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "hnsw_sq8":
+        index = faiss.IndexHNSWSQ(
+            embed_size,
+            faiss.ScalarQuantizer.QT_8bit,
+            m,
+            faiss.METRIC_INNER_PRODUCT,
+        )
+        index.train(embeddings)
+    else:
+        raise ValueError(f"Invalid index type: {index_type}")
+
+    index.hnsw.efConstruction = ef_construction
+    index.add(embeddings)
+
+    if path is not None:
+        faiss.write_index(index, str(path))
+        logger.debug(f"FAISS index saved in {path}")
+
+    return index
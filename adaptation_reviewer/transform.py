@@ -7,23 +7,24 @@ environment.
 """
 
 import gzip
-import json
 import logging
 import os
-from itertools import batched
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import batched, islice
 from pathlib import Path
 from time import time
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 
-import pandas as pd
-from joblib import Parallel, delayed
-from joblib_progress import joblib_progress
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyarrow import json as pajson
 
-from adaptation_reviewer.utils import (
-    list_to_datetime,
-    standardize_headers,
-    flatten_author,
-)
+from adaptation_reviewer.pbar import progress_bar
+from adaptation_reviewer.utils import flatten_author
 
 logging.basicConfig(
     level=logging.INFO,
@@ -32,12 +33,86 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def open_compressed_json(file_path: Path) -> List[dict]:
-    """Open a compressed JSON file
+# Arrow schema of the Crossref fields we keep. Other fields are ignored
+_DATE_PARTS = pa.struct([("date-parts", pa.list_(pa.list_(pa.int64())))])
+
+ITEM_SCHEMA = pa.schema(
+    [
+        ("DOI", pa.string()),
+        ("title", pa.list_(pa.string())),
+        ("URL", pa.string()),
+        ("published", _DATE_PARTS),
+        (
+            "created",
+            pa.struct(
+                [
+                    ("date-parts", pa.list_(pa.list_(pa.int64()))),
+                    ("date-time", pa.string()),
+                    ("timestamp", pa.int64()),
+                ]
+            ),
+        ),
+        ("publisher", pa.string()),
+        ("is-referenced-by-count", pa.int64()),
+        ("container-title", pa.list_(pa.string())),
+        ("reference-count", pa.int64()),
+        ("type", pa.string()),
+        ("volume", pa.string()),
+        (
+            "journal-issue",
+            pa.struct(
+                [
+                    ("issue", pa.string()),
+                    ("published-print", _DATE_PARTS),
+                ]
+            ),
+        ),
+        ("language", pa.string()),
+        (
+            "author",
+            pa.list_(
+                pa.struct(
+                    [
+                        ("given", pa.string()),
+                        ("family", pa.string()),
+                        ("sequence", pa.string()),
+                        (
+                            "affiliation",
+                            pa.list_(pa.struct([("name", pa.string())])),
+                        ),
+                    ]
+                )
+            ),
+        ),
+        (
+            "link",
+            pa.list_(
+                pa.struct(
+                    [
+                        ("URL", pa.string()),
+                        ("content-type", pa.string()),
+                        ("content-version", pa.string()),
+                        ("intended-application", pa.string()),
+                    ]
+                )
+            ),
+        ),
+        ("abstract", pa.string()),
+    ]
+)
+
+SCHEMA = pa.schema([("items", pa.list_(pa.struct(list(ITEM_SCHEMA))))])
 
-    This function reads a compressed JSON file and returns the data as a list of
-    dictionaries. This function is meant to be used in the `generate_parquet`
-    function.
+
+def read_gz_as_arrow(file_path: Path) -> pa.Table:
+    """Read a compressed Crossref JSON file as an Arrow table
+
+    This function reads a compressed JSON file using the Arrow JSON reader,
+    which parses the data in C++ instead of creating Python dictionaries. Each
+    Crossref file is a single JSON object with the records in `"items"`, so the
+    records are unnested to get one row per record. Only the fields in
+    `ITEM_SCHEMA` are kept. This function is meant to be used in the
+    `json_records_to_parquet` function.
 
     Parameters
     ----------
@@ -46,86 +121,239 @@ def open_compressed_json(file_path: Path) -> List[dict]:
 
     Returns
     -------
-    list
-        List of dictionaries with the JSON data
+    pa.Table
+        Table with one row per record and the columns in `ITEM_SCHEMA`
     """
 
-    subset_cols = [
-        "DOI",
-        "title",
-        "URL",
-        "published",
-        "created",
-        "publisher",
-        "is-referenced-by-count",
-        "container-title",
-        "reference-count",
-        "type",
-        "volume",
-        "journal-issue",
-        "language",
-        "author",
-        "link",
-        "abstract",
-    ]
-
     with gzip.open(file_path, "rb") as f:
-        records = json.load(f)["items"]
+        data = f.read()
+
+    # The whole file is a single JSON object, so it has to fit in one block
+    table = pajson.read_json(
+        pa.BufferReader(data),
+        read_options=pajson.ReadOptions(block_size=max(len(data), 1 << 20)),
+        parse_options=pajson.ParseOptions(
+            explicit_schema=SCHEMA,
+            newlines_in_values=True,
+            unexpected_field_behavior="ignore",
+        ),
+    )
 
-    # Filter the dictionaries to keep only the keys in subset_cols
-    records = [
-        {key: record.get(key, None) for key in subset_cols}
-        for record in records
-    ]
+    # Unnest the items list: one row per record
+    items = pc.list_flatten(table.column("items"))
+    table = pa.Table.from_batches(
+        [pa.RecordBatch.from_struct_array(chunk) for chunk in items.chunks],
+        schema=ITEM_SCHEMA,
+    )
 
-    return records
+    return table.select(ITEM_SCHEMA.names)
 
 
-def json_records_to_parquet(
-    list_files: Tuple[Path],
-    output_dir: str,
-    row_group_size: int = 100_000,
-    flatten_authors: bool = False,
-) -> None:
-    """Transform list of JSON files to Parquet"""
+def _first_element(arr: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Get the first element of each list, null if the list is empty"""
 
-    list_files = list(list_files)
+    non_empty = pc.greater(pc.list_value_length(arr), 0)
+    arr = pc.if_else(non_empty, arr, pa.scalar(None, type=arr.type))
 
-    list_files.sort(key=lambda x: int(x.stem.split(".")[0]))
-    min_file, max_file = (
-        int(list_files[0].stem.split(".")[0]),
-        int(list_files[-1].stem.split(".")[0]),
-    )
+    return pc.list_element(arr, 0)
 
-    file_name = f"{min_file}_{max_file}.parquet"
 
-    df = [pd.json_normalize(open_compressed_json(file)) for file in list_files]
-    df = pd.concat(df, ignore_index=True)
+def clean_records(table: pa.Table, flatten_authors: bool = False) -> pa.Table:
+    """Clean a table of Crossref records read with `read_gz_as_arrow`
+
+    Nested structs are flattened and the column names are standardized (i.e.
+    `published.date-parts` becomes `published_date_parts`). The publication
+    year is extracted and the title and container title are parsed as strings.
+    If `flatten_authors` is True, the first 4 authors are flattened into
+    `given_*`, `family_*` and `affiliation_*` columns.
+
+    Parameters
+    ----------
+    table : pa.Table
+        Table with the raw Crossref records
+    flatten_authors : bool, optional
+        Flatten the author data. The default is False.
+
+    Returns
+    -------
+    pa.Table
+        Table with the schema returned by `output_schema`
+    """
+
+    # Flatten nested structs (i.e. published.date-parts) until no struct is left
+    while any(pa.types.is_struct(field.type) for field in table.schema):
+        table = table.flatten()
 
     # Standardize headers
-    df = standardize_headers(df)
+    table = table.rename_columns(
+        [re.sub("[.-]", "_", col).lower() for col in table.column_names]
+    )
 
     # Do some cleaning
-    df["year"] = df["published_date_parts"].apply(list_to_datetime)
+    table = table.append_column(
+        "year", _first_element(_first_element(table["published_date_parts"]))
+    )
     # Parse stuff as strings, not lists
-    df["container_title"] = df.container_title.str[0]
-    df["title"] = df.title.str[0]
+    table = table.set_column(
+        table.schema.get_field_index("container_title"),
+        "container_title",
+        _first_element(table["container_title"]),
+    )
+    table = table.set_column(
+        table.schema.get_field_index("title"),
+        "title",
+        _first_element(table["title"]),
+    )
 
     # Flatten authors
     if flatten_authors:
+        schema = output_schema(flatten_authors=True)
+        df = table.to_pandas()
+
         # Remove all stuff without author elements
         df = df[~df.author.isna()]
+        if df.empty:
+            return schema.empty_table()
 
-        # Do our own et. al. here
-        df.loc[:, "author"] = df.author.apply(lambda x: x[:4])
+        table = pa.Table.from_pandas(flatten_author(df), preserve_index=False)
+
+        # Papers with less than 4 authors do not create all the author columns
+        table = pa.table(
+            [
+                (
+                    table[field.name]
+                    if field.name in table.column_names
+                    else pa.nulls(table.num_rows, field.type)
+                )
+                for field in schema
+            ],
+            names=schema.names,
+        ).cast(schema)
 
-        df = flatten_author(df)
+    return table
 
-    df.to_parquet(
-        os.path.join(output_dir, file_name),
-        index=False,
-        row_group_size=row_group_size,
+
+def output_schema(flatten_authors: bool = False) -> pa.Schema:
+    """Schema of the tables returned by `clean_records`"""
+
+    schema = clean_records(ITEM_SCHEMA.empty_table()).schema
+
+    if flatten_authors:
+        author_fields = [
+            pa.field(f"{name}_{num}", dtype)
+            for name, dtype in [
+                ("given", pa.string()),
+                ("family", pa.string()),
+                ("affiliation", pa.list_(pa.string())),
+            ]
+            for num in range(1, 5)
+        ]
+        schema = pa.schema(author_fields + list(schema))
+
+    return schema
+
+
+def _iter_records(
+    list_files: List[Path],
+    flatten_authors: bool = False,
+    executor: None | ThreadPoolExecutor = None,
+    max_pending: int = 8,
+) -> Iterator[pa.Table]:
+    """Read and clean JSON files in order, parsing ahead in the executor
+
+    Without an executor, files are parsed one at a time. With an executor, at
+    most `max_pending` files are parsed ahead of the consumer, so memory stays
+    bounded while the writer is busy.
+    """
+
+    def parse(file):
+        return clean_records(read_gz_as_arrow(file), flatten_authors)
+
+    if executor is None:
+        yield from (parse(file) for file in list_files)
+        return
+
+    files = iter(list_files)
+    pending = deque(
+        executor.submit(parse, file)
+        for file in islice(files, max_pending)
     )
+    while pending:
+        table = pending.popleft().result()
+        file = next(files, None)
+        if file is not None:
+            pending.append(executor.submit(parse, file))
+        yield table
+
+
+def json_records_to_parquet(
+    list_files: Tuple[Path],
+    output_dir: str,
+    row_group_size: int = 1_000_000,
+    flatten_authors: bool = False,
+    executor: None | ThreadPoolExecutor = None,
+    max_pending: int = 8,
+) -> None:
+    """Transform list of JSON files to Parquet
+
+    Files are streamed to a single `ParquetWriter`. Records are buffered until
+    there are `row_group_size` rows, so row groups keep the same size
+    regardless of the number of records per JSON file. Memory therefore grows
+    with `row_group_size`: a full buffer is concatenated before it is written,
+    so up to two copies of one row group are held at once. With the default
+    `row_group_size` equal to `rows_per_file` that is the whole output file;
+    use a smaller `row_group_size` to lower the peak. If an `executor` is
+    passed, files are parsed in its threads while this thread writes, with at
+    most `max_pending` parsed files waiting to be written.
+    """
+
+    list_files = list(list_files)
+
+    list_files.sort(key=lambda x: int(x.stem.split(".")[0]))
+    min_file, max_file = (
+        int(list_files[0].stem.split(".")[0]),
+        int(list_files[-1].stem.split(".")[0]),
+    )
+
+    file_name = f"{min_file}_{max_file}.parquet"
+    out_path = os.path.join(output_dir, file_name)
+
+    try:
+        with pq.ParquetWriter(
+            out_path,
+            output_schema(flatten_authors),
+            compression="zstd",
+            compression_level=3,
+            use_dictionary=True,
+            data_page_size=1 << 20,
+        ) as writer:
+            buffer = []
+            buffered_rows = 0
+            for table in _iter_records(
+                list_files, flatten_authors, executor, max_pending
+            ):
+                buffer.append(table)
+                buffered_rows += table.num_rows
+
+                # Write full row groups and keep the remainder in the buffer
+                if buffered_rows >= row_group_size:
+                    table = pa.concat_tables(buffer)
+                    n_rows = (table.num_rows // row_group_size) * row_group_size
+                    writer.write_table(
+                        table.slice(0, n_rows), row_group_size=row_group_size
+                    )
+                    buffer = [table.slice(n_rows)]
+                    buffered_rows = table.num_rows - n_rows
+
+            if buffered_rows > 0:
+                writer.write_table(
+                    pa.concat_tables(buffer), row_group_size=row_group_size
+                )
+    except BaseException:
+        # Do not leave a partial file behind, `create_table` would read it
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
 
     logger.debug(f"Saving {file_name} to {output_dir}")
 
@@ -135,11 +363,12 @@ def json_records_to_parquet(
 def generate_parquet_from_list(
     compressed_json_files: List[Path],
     output_dir: str | Path,
-    row_group_size: int = 100_000,
+    row_group_size: int = 1_000_000,
     rows_per_file: int = 1_000_000,
     n_jobs: int = -1,
     flatten_authors: bool = False,
     json_file_record_default: int = 5_000,
+    n_writers: int = 2,
 ) -> None:
     """Transform list of JSON files to Parquet
 
@@ -156,9 +385,17 @@ def generate_parquet_from_list(
     rows_per_file : int
         Number of rows per Parquet file
     row_group_size : int
-        Number of rows per row group in the Parquet file
+        Number of rows per row group in the Parquet file. Each writer buffers
+        up to one row group in memory, so lower it to reduce memory use
+    n_jobs : int
+        Number of threads used to parse the JSON files. Use -1 for all cores
+    n_writers : int
+        Number of Parquet files written at the same time
     """
 
+    if n_jobs < 1:
+        n_jobs = os.cpu_count()
+
     if isinstance(output_dir, str):
         output_dir = Path(output_dir)
 
@@ -177,20 +414,174 @@ def generate_parquet_from_list(
     # Build chunks
     file_chunks = batched(compressed_json_files, chunk_size)
 
-    # Process in parallel
-    with joblib_progress(
-        "JSON --> Parquet in parallel",
-        total=len(compressed_json_files) // chunk_size,
+    # Parse JSON in threads (gzip and the Arrow JSON reader release the GIL)
+    # and write up to `n_writers` Parquet files at the same time, each one from
+    # a single writer thread (Parquet encoding also releases the GIL)
+    with (
+        progress_bar as p,
+        ThreadPoolExecutor(max_workers=n_jobs) as parse_pool,
+        ThreadPoolExecutor(max_workers=n_writers) as write_pool,
     ):
-        Parallel(n_jobs=n_jobs)(
-            delayed(json_records_to_parquet)(
-                chunk, output_dir, row_group_size, flatten_authors
+        task = p.add_task(
+            "JSON --> Parquet",
+            total=-(-len(compressed_json_files) // chunk_size),
+        )
+        futures = [
+            write_pool.submit(
+                json_records_to_parquet,
+                chunk,
+                output_dir,
+                row_group_size,
+                flatten_authors,
+                executor=parse_pool,
+                max_pending=max(2 * n_jobs // n_writers, 1),
             )
             for chunk in file_chunks
-        )
+        ]
+        try:
+            for future in as_completed(futures):
+                future.result()
+                p.advance(task)
+        except BaseException:
+            # Stop parsing and writing the remaining chunks on the first error
+            write_pool.shutdown(wait=False, cancel_futures=True)
+            parse_pool.shutdown(wait=False, cancel_futures=True)
+            raise
 
     end_time = time()
     logger.info(
         f"Extracted {len(compressed_json_files):,} files in {end_time - start_time:.2f} seconds"
     )
     return None
+
+
+def _duckdb_type(dtype: pa.DataType) -> str:
+    """Translate an Arrow type from `ITEM_SCHEMA` to a DuckDB type"""
+
+    if pa.types.is_string(dtype):
+        return "VARCHAR"
+    elif pa.types.is_int64(dtype):
+        return "BIGINT"
+    elif pa.types.is_list(dtype):
+        return f"{_duckdb_type(dtype.value_type)}[]"
+    elif pa.types.is_struct(dtype):
+        fields = ", ".join(
+            f'"{field.name}" {_duckdb_type(field.type)}' for field in dtype
+        )
+        return f"STRUCT({fields})"
+    else:
+        raise ValueError(f"Unsupported type: {dtype}")
+
+
+def json_to_parquet_duckdb(
+    input_dir: str | Path,
+    output_dir: str | Path,
+    row_group_size: int = 1_000_000,
+    rows_per_file: int = 1_000_000,
+    flatten_authors: bool = False,
+    con: None | duckdb.DuckDBPyConnection = None,
+) -> None:
+    """Transform all JSON files in a directory to Parquet using DuckDB
+
+    This function does the same as `generate_parquet_from_list`, but the JSON
+    parsing, cleaning and Parquet writing happen inside DuckDB, so no Python
+    objects are created for the records. The output has the same columns as
+    `clean_records`, so it can be used in the `create_table` function. Files
+    are written as `data_<n>.parquet` in `output_dir`.
+
+    Parameters
+    ----------
+    input_dir : str or Path
+        Path to the raw Crossref data. All `.json.gz` files are read
+    output_dir : str or Path
+        Path to save the Parquet files
+    row_group_size : int
+        Number of rows per row group in the Parquet file
+    rows_per_file : int
+        Number of rows per Parquet file
+    flatten_authors : bool
+        Flatten the first 4 authors into `given_*`, `family_*` and
+        `affiliation_*` columns
+    con : duckdb.DuckDBPyConnection, optional
+        Connection to use. The default is an in-memory connection.
+    """
+
+    if con is None:
+        con = duckdb.connect()
+
+    items_type = _duckdb_type(SCHEMA.field("items").type)
+
+    author = "item.author"
+    author_cols = ""
+    author_filter = ""
+    if flatten_authors:
+        # Do our own et. al. here
+        author = "list_slice(item.author, 1, 4)"
+        # Same columns and order as `output_schema`. Empty affiliation lists
+        # are NULL, as `normalize_affiliation` does in `clean_records`
+        for name, expr in [
+            ("given", "item.author[{num}].given"),
+            ("family", "item.author[{num}].family"),
+            (
+                "affiliation",
+                "nullif(list_transform("
+                "item.author[{num}].affiliation, x -> x.name), [])",
+            ),
+        ]:
+            author_cols += "".join(
+                f"\n            {expr.format(num=num)} AS {name}_{num},"
+                for num in range(1, 5)
+            )
+        author_filter = "WHERE item.author IS NOT NULL"
+
+    query = f"""
+        COPY (
+            SELECT {author_cols}
+            item."DOI" AS doi,
+            item.title[1] AS title,
+            item."URL" AS url,
+            item.published."date-parts" AS published_date_parts,
+            item.created."date-parts" AS created_date_parts,
+            item.created."date-time" AS created_date_time,
+            item.created."timestamp" AS created_timestamp,
+            item.publisher AS publisher,
+            item."is-referenced-by-count" AS is_referenced_by_count,
+            item."container-title"[1] AS container_title,
+            item."reference-count" AS reference_count,
+            item."type" AS type,
+            item.volume AS volume,
+            item."journal-issue".issue AS journal_issue_issue,
+            item."journal-issue"."published-print"."date-parts"
+                AS journal_issue_published_print_date_parts,
+            item."language" AS language,
+            {author} AS author,
+            item.link AS link,
+            item.abstract AS abstract,
+            item.published."date-parts"[1][1] AS year,
+            FROM (
+                SELECT unnest(items) AS item
+                FROM read_json(
+                    '{Path(input_dir)}/**/*.json.gz',
+                    compression='gzip',
+                    format='auto',
+                    columns={{'items': '{items_type}'}},
+                    maximum_object_size=1073741824
+                )
+            )
+            {author_filter}
+        ) TO '{Path(output_dir)}' (
+            FORMAT PARQUET,
+            ROW_GROUP_SIZE {row_group_size},
+            ROW_GROUPS_PER_FILE {max(rows_per_file // row_group_size, 1)},
+            COMPRESSION ZSTD,
+            OVERWRITE_OR_IGNORE
+        )
+        """
+
+    start_time = time()
+    con.execute(query)
+    logger.info(
+        f"Transformed JSON files in {time() - start_time:.2f} seconds with DuckDB"
+    )
+
+    return None
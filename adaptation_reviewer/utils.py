@@ -3,42 +3,6 @@ import numpy as np
 from typing import List
 
 
-def list_to_datetime(date_list):
-    """Aux function to convert a list to get the year only"""
-
-    if isinstance(date_list, list):
-        return date_list[0][0]
-    elif isinstance(date_list, float):
-        if pd.isna(date_list):
-            return np.nan
-        else:
-            return int(date_list)
-    else:
-        raise ValueError("Invalid date list format")
-
-
-def standardize_headers(df: pd.DataFrame, func=None) -> pd.DataFrame:
-    """Helper function to standarize column names for an arbitrary DataFrame
-
-    Parameters
-    ----------
-    df : pd.DataFrame
-        DataFrame to be standarized
-    func : callable, optional
-        A function to apply to the DataFrame. The default is None.
-
-    Returns
-    -------
-    pd.DataFrame
-    """
-
-    df.columns = df.columns.str.replace("[.-]", "_", regex=True).str.lower()
-    if func:
-        df = df.apply(func)
-
-    return df
-
-
 def flatten_author(df: pd.DataFrame) -> pd.DataFrame:
     """Extract flattened author data from a list of nested dictionaries
 
@@ -67,10 +31,16 @@ def flatten_author(df: pd.DataFrame) -> pd.DataFrame:
     pd.DataFrame
 
     """
-    # Explore author columns to max 4 (et.al. limit)
+    # Explore author columns to max 4 (et.al. limit). Cut before exploding so
+    # the exploded frame is at most 4x the number of papers
+    df = df.assign(author=df.author.str[:4])
     df_exp = df.explode("author")
 
-    df_auth = df_exp.author.apply(lambda x: pd.Series(x))
+    # Build the author frame in one go. Papers with no authors explode to NaN
+    df_auth = pd.DataFrame(
+        [a if isinstance(a, dict) else {} for a in df_exp.author],
+        index=df_exp.index,
+    )
     df_auth["doi"] = df_exp.doi.values
     df_auth["auth_num"] = df_auth.groupby("doi").cumcount() + 1
 
@@ -85,10 +55,11 @@ def flatten_author(df: pd.DataFrame) -> pd.DataFrame:
     df_auth.columns = [f"{a}_{b}" for a, b in df_auth.columns]
 
     # Normalize affiliation to only get names in a list. Make life easier to DuckDB
-    affiliation_cols = df_auth.filter(like="affiliation_")
-    df_auth[affiliation_cols.columns] = affiliation_cols.applymap(
-        normalize_affiliation
-    )
+    affiliation_cols = df_auth.filter(like="affiliation_").columns
+    affiliations = df_auth[affiliation_cols].to_numpy(dtype=object)
+    df_auth[affiliation_cols] = np.frompyfunc(normalize_affiliation, 1, 1)(
+        affiliations.ravel()
+    ).reshape(affiliations.shape)
 
     # Merge stuff
     df = df_auth.merge(df, left_on="doi_", right_on="doi")
@@ -114,14 +85,14 @@ def normalize_affiliation(affiliation: list | pd.Series) -> List:
     -------
         List with flattened affiliations
     """
-    if isinstance(affiliation, float):
+    if affiliation is None or isinstance(affiliation, float):
         return None
 
     if len(affiliation) == 0:
         return None
 
-    normalized = []
-    for item in affiliation:
-        if isinstance(item, dict) and "name" in item:
-            normalized.append(item["name"])
-    return normalized
+    return [
+        item["name"]
+        for item in affiliation
+        if isinstance(item, dict) and "name" in item
+    ]
@@ -1,7 +1,10 @@
 import os
+import duckdb
+import pandas as pd
 import pytest
 from typer.testing import CliRunner
 from adaptation_reviewer.cli import app
+from adaptation_reviewer.process import create_table
 from tests.conftest import load_data
 
 runner = CliRunner()
@@ -28,3 +31,45 @@ def test_create_db(sample_parquet, tmp_path):
     )
     assert result.exit_code == 0
     assert os.path.exists(db_path)
+
+
+def test_create_table_matchers_agree(tmp_path):
+    pytest.importorskip("ahocorasick")
+
+    abstracts = [
+        "Climate ADAPTATION in cities",
+        "<jats:p>climate adaptation and policy</jats:p>",
+        "Only climate here",
+        "ADAPTATION without the other keyword",
+        None,
+        "cLiMaTe change and AdApTaTiOn",
+    ]
+    pd.DataFrame(
+        {
+            "doi": [f"10.1/{idx}" for idx in range(len(abstracts))],
+            "title": "Title",
+            "family_1": "Smith",
+            "given_1": "Ana",
+            "year": 2020,
+            "abstract": abstracts,
+            "type": "journal-article",
+        }
+    ).to_parquet(tmp_path / "sample.parquet")
+
+    con = duckdb.connect()
+    dois = {
+        matcher: sorted(
+            create_table(
+                str(tmp_path),
+                ["Climate", "adaptation"],
+                "papers",
+                con=con,
+                create_table=False,
+                matcher=matcher,
+            ).doi
+        )
+        for matcher in ["regex", "aho-corasick"]
+    }
+
+    assert dois["regex"] == dois["aho-corasick"]
+    assert dois["regex"] == ["10.1/0", "10.1/1", "10.1/5"]
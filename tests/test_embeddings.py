@@ -0,0 +1,60 @@
+import duckdb
+import numpy as np
+import pyarrow as pa
+from adaptation_reviewer.process import load_embeddings, similarity_search
+
+
+def test_similarity_search():
+    embeddings = np.eye(4, dtype=np.float32)
+    queries = np.array([[0, 1, 0, 0], [0.1, 0, 0, 0.9]], dtype=np.float32)
+
+    idx, scores = similarity_search(queries, embeddings, top_k=2)
+
+    assert idx.shape == scores.shape == (2, 2)
+    assert idx.tolist() == [[1, 0], [3, 0]]
+    np.testing.assert_allclose(scores, [[1, 0], [0.9, 0.1]])
+
+
+def test_similarity_search_1d_query_and_large_top_k():
+    embeddings = np.eye(3, dtype=np.float32)
+
+    idx, scores = similarity_search(embeddings[2], embeddings, top_k=10)
+
+    assert idx.shape == (1, 3)
+    assert idx[0, 0] == 2
+
+
+def test_similarity_search_empty_embeddings():
+    embeddings = np.empty((0, 4), dtype=np.float32)
+
+    idx, scores = similarity_search(np.ones(4), embeddings, top_k=5)
+
+    assert idx.shape == scores.shape == (1, 0)
+
+
+def test_load_embeddings_roundtrip():
+    con = duckdb.connect()
+    embeddings = np.random.default_rng(0).random((5, 3), dtype=np.float32)
+    ids = [f"id{i}" for i in range(5)]
+
+    tbl = pa.table(
+        {
+            "id": ids,
+            "embeddings": pa.FixedSizeListArray.from_arrays(
+                pa.array(embeddings.reshape(-1)), 3
+            ),
+        }
+    )
+    con.register("embed_tmp", tbl)
+    con.execute(
+        """
+        CREATE TABLE papers_embed_abstracts AS
+        SELECT id, embeddings::FLOAT4[3] AS embeddings FROM embed_tmp
+        """
+    )
+
+    loaded_ids, loaded = load_embeddings("papers", con)
+
+    assert loaded_ids.tolist() == ids
+    assert loaded.dtype == np.float32
+    np.testing.assert_array_equal(loaded, embeddings)
@@ -1,8 +1,14 @@
 import os
+import gzip
 import json
 import pytest
+import pyarrow.parquet as pq
 from typer.testing import CliRunner
 from adaptation_reviewer.cli import app
+from adaptation_reviewer.transform import (
+    generate_parquet_from_list,
+    output_schema,
+)
 from tests.conftest import load_data
 
 runner = CliRunner()
@@ -28,3 +34,129 @@ def test_transform_crossref(sample_json, tmp_path):
     )
     assert result.exit_code == 0
     assert os.path.exists(tmp_path / "sample.parquet")
+
+
+def write_crossref_files(path):
+    """Write two small gzipped Crossref files with edge cases"""
+    authors = [
+        {"given": "Ana", "family": "Smith", "affiliation": [{"name": "S"}]},
+        {"given": "Bo", "family": "Lee", "affiliation": []},
+        {"given": "Cy", "family": "Ng"},
+        {"given": "Di", "family": "Wu", "affiliation": [{"name": "A"}]},
+        {"given": "Ed", "family": "Ro", "affiliation": [{"name": "B"}]},
+    ]
+    for num in range(2):
+        items = [
+            {
+                "DOI": f"10.1/{num}-{idx}",
+                "title": [f"Title {idx}"] if idx % 3 else [],
+                "published": {"date-parts": [[2000 + idx, 1]]},
+                "container-title": ["Journal"],
+                "type": "journal-article",
+                "author": authors[: idx + 1],
+                "abstract": "<jats:p>Abstract adaptation</jats:p>",
+                "subject": ["not in the schema"],
+            }
+            for idx in range(5)
+        ]
+        with gzip.open(path / f"{num}.json.gz", "wt") as f:
+            json.dump({"items": items}, f)
+
+
+@pytest.mark.parametrize("flatten_authors", [False, True])
+def test_transform_duckdb_matches_crossref(tmp_path, flatten_authors):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    write_crossref_files(raw)
+
+    for command in ["transform-crossref", "transform-duckdb"]:
+        args = [command, str(raw), str(tmp_path / command)]
+        if flatten_authors:
+            args.append("--flatten-authors")
+        result = runner.invoke(app, args)
+        assert result.exit_code == 0, result.output
+
+    arrow_tbl = pq.read_table(tmp_path / "transform-crossref").sort_by("doi")
+    duckdb_tbl = pq.read_table(tmp_path / "transform-duckdb").sort_by("doi")
+
+    assert arrow_tbl.column_names == duckdb_tbl.column_names
+    assert arrow_tbl.num_rows == 10
+    for col in arrow_tbl.column_names:
+        assert (
+            arrow_tbl[col].to_pylist() == duckdb_tbl[col].to_pylist()
+        ), col
+
+
+def test_transform_crossref_large_file(tmp_path):
+    """Crossref files are one JSON object, larger than Arrow's default block"""
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    items = [
+        {
+            "DOI": f"10.1/{idx}",
+            "title": [f"Title {idx}"],
+            "type": "journal-article",
+            "abstract": f"<jats:p>Abstract {idx} " + "adaptation " * 50,
+        }
+        for idx in range(5_000)
+    ]
+    with gzip.open(raw / "0.json.gz", "wt") as f:
+        json.dump({"items": items}, f, indent=2)
+    assert (
+        len(gzip.decompress((raw / "0.json.gz").read_bytes())) > 1 << 20
+    )
+
+    result = runner.invoke(
+        app, ["transform-crossref", str(raw), str(tmp_path / "out")]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert pq.read_table(tmp_path / "out").num_rows == 5_000
+
+
+def test_generate_parquet_stops_on_error(tmp_path):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    (raw / "0.json.gz").write_bytes(gzip.compress(b'{"items": [{"DOI": '))
+    for num in range(1, 12):
+        with gzip.open(raw / f"{num}.json.gz", "wt") as f:
+            json.dump({"items": [{"DOI": f"10.1/{num}"}]}, f)
+
+    with pytest.raises(Exception):
+        generate_parquet_from_list(
+            list(raw.glob("*.json.gz")),
+            tmp_path / "out",
+            rows_per_file=1,
+            n_jobs=1,
+            json_file_record_default=1,
+            n_writers=1,
+        )
+
+    written = os.listdir(tmp_path / "out")
+    assert "0_0.parquet" not in written
+    assert len(written) < 11
+
+
+@pytest.mark.parametrize(
+    "items", [[], [{"DOI": "10.1/0", "type": "journal-article"}]]
+)
+def test_transform_crossref_without_authors(tmp_path, items):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    with gzip.open(raw / "0.json.gz", "wt") as f:
+        json.dump({"items": items}, f)
+
+    result = runner.invoke(
+        app,
+        [
+            "transform-crossref",
+            str(raw),
+            str(tmp_path / "out"),
+            "--flatten-authors",
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    table = pq.read_table(tmp_path / "out")
+    assert table.num_rows == 0
+    assert table.schema == output_schema(flatten_authors=True)